@@ -6,6 +6,7 @@ import math
 import os
 import random
 import re
+import shutil
 import stat
 import uuid
 from dataclasses import dataclass
@@ -14,6 +15,7 @@ from typing import Optional, Union
 import click
 import subprocess
 import jinja2
+from .runcache import RunCache
 
 PERF_PREFIX = f'stat -B -e'
 PERF_EVENTS = [
@@ -57,6 +59,7 @@ class BenchConfig:
     clearcache_path: str = "/opt/clearcache"
     billing: Optional[str] = None
     max_parallel_jobs: Optional[int] = None
+    max_array_size: int = 1001
     overwrite: bool = False
     email: Optional[str] = None
     write_scheduler_logs: Optional[bool] = True
@@ -66,6 +69,13 @@ class BenchConfig:
     data_to_main_mem = True
     exclude_nodes: Optional[Union[str, list]] = None
     postprocess_stdout_regex: str = None
+    run_cache: Optional[str] = None
+    run_cache_max_size: Optional[int] = None
+    run_cache_link: bool = False
+    pilot_mode: bool = False
+    pilot_nodes: int = 1
+    pilot_time_limit: int = 24 * 3600
+    merge_benches: bool = False
 
 
 def submit_to_slurm(slurm_file: str, prev_job_id: int = None) -> int:
@@ -79,6 +89,129 @@ def submit_to_slurm(slurm_file: str, prev_job_id: int = None) -> int:
     return job_id
 
 
+def write_jobs(bench_config: BenchConfig, templateEnv: jinja2.Environment, starthome: str, base_path: Path,
+               benchmark_name: str, start_scripts: list, cpus: int, cache_lines: int, slurm_time: int,
+               pilot_slots: int, submit: Optional[str], sub_benches: Optional[list] = None) -> None:
+    if not bench_config.pilot_mode and len(start_scripts) >= bench_config.max_array_size:
+        # slurm rejects array indices of MaxArraySize or above
+        print(f"{len(start_scripts)} runs in {os.path.realpath(base_path)} exceed the maximum array size of "
+              f"{bench_config.max_array_size}. Increase max_array_size to the MaxArraySize of the cluster or use "
+              f"pilot_mode, then delete {os.path.realpath(base_path)} and regenerate. Exiting...")
+        exit(2)
+    bench_path = os.path.relpath(base_path, start=starthome)
+    slurm_template = templateEnv.get_template('batch_job.slurm.jinja2')
+    slurm_timeout = datetime.timedelta(seconds=slurm_time)
+    mem_per_cpu = int(math.ceil(bench_config.mem_limit / cpus))
+    min_freq = bench_config.cpu_freq * 1000
+    max_freq = bench_config.cpu_freq * 1000
+    output_path = 'slurm_logs'
+    os.makedirs(base_path / output_path, exist_ok=True)
+    outputText = slurm_template.render(benchmark_name=benchmark_name, slurm_timeout=slurm_timeout,
+                                    partition=bench_config.partition, cpus_per_task=cpus,
+                                    mem_per_cpu=mem_per_cpu, email=bench_config.email,
+                                    account=bench_config.billing,
+                                    cache_lines=cache_lines,
+                                    min_freq=min_freq, max_freq=max_freq,
+                                    write_scheduler_logs=bench_config.write_scheduler_logs,
+                                    output_path=output_path,
+                                    max_parallel_jobs=bench_config.max_parallel_jobs,
+                                    lstart_scripts=len(start_scripts), exclusive=bench_config.exclusive,
+                                    bench_path=bench_path,
+                                    exclude_nodes=bench_config.exclude_nodes)
+    if bench_config.pilot_mode:
+        rounds = math.ceil(len(start_scripts) / (bench_config.pilot_nodes * pilot_slots)) + 1
+        pilot_time = rounds * slurm_time + bench_config.slurm_time_buffer
+        if pilot_time > bench_config.pilot_time_limit:
+            pilot_time = bench_config.pilot_time_limit
+            runs_per_pilot = (pilot_time - bench_config.slurm_time_buffer) // slurm_time * pilot_slots
+            print(f"Pilot wall time capped at {datetime.timedelta(seconds=pilot_time)}. Each submission finishes about "
+                  f"{runs_per_pilot * bench_config.pilot_nodes} of {len(start_scripts)} runs, resubmit "
+                  f"{os.path.abspath(base_path / 'batch_job.slurm')} for the remaining ones.")
+        pilot_template = templateEnv.get_template('pilot_job.slurm.jinja2')
+        outputText = pilot_template.render(benchmark_name=benchmark_name,
+                                           slurm_timeout=datetime.timedelta(seconds=pilot_time),
+                                           partition=bench_config.partition,
+                                           cpus_per_node=bench_config.cpus_per_node,
+                                           email=bench_config.email, account=bench_config.billing,
+                                           min_freq=min_freq, max_freq=max_freq,
+                                           write_scheduler_logs=bench_config.write_scheduler_logs,
+                                           output_path=output_path,
+                                           max_parallel_jobs=bench_config.max_parallel_jobs,
+                                           pilot_nodes=bench_config.pilot_nodes,
+                                           pilot_time=pilot_time, run_time=slurm_time,
+                                           time_buffer=bench_config.slurm_time_buffer,
+                                           max_slots=pilot_slots, slot_cpus=cpus,
+                                           mem_limit=bench_config.mem_limit, bench_path=bench_path,
+                                           exclude_nodes=bench_config.exclude_nodes)
+        # reset the task queue of previous submissions
+        for queue_file in ['pilot_queue.txt', 'pilot_queue.lock']:
+            if os.path.exists(base_path / queue_file):
+                os.remove(base_path / queue_file)
+    with open(base_path / 'batch_job.slurm', 'w') as fh:
+        fh.write(outputText)
+
+    postprocess_partition = bench_config.partition
+    if bench_config.postprocess_partition != None:
+        postprocess_partition = bench_config.postprocess_partition
+
+    compress_results_slurm = templateEnv.get_template('compress_results.slurm.jinja2')
+    outputText = compress_results_slurm.render(benchmark_name=benchmark_name, partition=postprocess_partition,
+                                            bench_path=bench_path,
+                                            write_scheduler_logs=bench_config.write_scheduler_logs,
+                                            output_path=output_path,
+                                            exclude_nodes=bench_config.exclude_nodes)
+    with open(base_path / 'compress_results.slurm', 'w') as fh:
+        fh.write(outputText)
+
+    module_dir = os.path.dirname(__file__) 
+    postprocess_script_path = os.path.join(module_dir, 'postprocess.py')
+
+    with open(postprocess_script_path, 'r') as f:
+        postprocess_content = f.read()
+    postprocess_path = Path(base_path, 'postprocess_results.py')
+    postprocess = templateEnv.get_template('postprocess_results.py.jinja2')
+    outputText = postprocess.render(postprocess_script=postprocess_content, regex=bench_config.postprocess_stdout_regex,
+                                    sub_benches=sub_benches)
+    with open(postprocess_path, 'w') as fh:
+        fh.write(outputText)
+    st = os.stat(postprocess_path)
+    os.chmod(postprocess_path, st.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
+
+    postprocess_results_slurm = templateEnv.get_template('postprocess_results.slurm.jinja2')
+    outputText = postprocess_results_slurm.render(benchmark_name=benchmark_name, partition=postprocess_partition,
+                                            bench_path=bench_path,
+                                            write_scheduler_logs=bench_config.write_scheduler_logs,
+                                            output_path=output_path,
+                                            exclude_nodes=bench_config.exclude_nodes,
+                                            postprocess_script=postprocess_path)
+    with open(base_path / 'postprocess_results.slurm', 'w') as fh:
+        fh.write(outputText)
+
+
+    submit_sh_path = Path(base_path, 'submit_all.sh')
+    submit_all = templateEnv.get_template('submit_all.sh.jinja2')
+    wd = os.path.relpath(base_path, start=starthome)
+    outputText = submit_all.render(wd=wd, submit_bench=len(start_scripts) > 0)
+    with open(submit_sh_path, 'w') as fh:
+        fh.write(outputText)
+
+    st = os.stat(submit_sh_path)
+    os.chmod(submit_sh_path, st.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
+
+    print(f"Wrote files to {os.path.abspath(base_path)}")
+    if len(start_scripts) == 0:
+        print(f"No runs of {os.path.abspath(base_path)} need to be executed, nothing to submit.")
+    if submit:
+        print(f"Submitting jobs directly to slurm...")
+        os.chdir(os.path.abspath(base_path))
+        prev_id = None
+        if (submit == "bench" or submit == "all") and len(start_scripts) > 0:
+            prev_id = submit_to_slurm('batch_job.slurm')
+        if submit == "postprocess" or submit == "all":
+            prev_id = submit_to_slurm('postprocess_results.slurm', prev_job_id=prev_id)
+        if submit == "compress" or submit == "all":
+            prev_id = submit_to_slurm('compress_results.slurm', prev_job_id=prev_id)
+
 
 @click.command()
 @click.argument('bench_config_file', type=Path)
@@ -103,6 +236,20 @@ def main(bench_config_file: Path, submit: str) -> None:
             wd = Path(os.path.dirname(bench_config_file), bench_config.working_dir)
             working_dir = os.path.relpath(os.path.realpath(wd), start=starthome)
 
+    run_cache = None
+    run_cache_dir = None
+    if bench_config.run_cache is not None:
+        if os.path.isabs(bench_config.run_cache) or bench_config.run_cache.startswith('~'):
+            cache_path = os.path.realpath(os.path.expanduser(bench_config.run_cache))
+        else:
+            cache_path = os.path.realpath(os.path.join(bench_config_dir, bench_config.run_cache))
+        run_cache = RunCache(cache_path, max_size=bench_config.run_cache_max_size)
+        if cache_path.startswith(starthome + os.sep):
+            run_cache_dir = f'~/{os.path.relpath(cache_path, start=starthome)}'
+        else:
+            run_cache_dir = cache_path
+    reused_runs = 0
+
     if bench_config.initial_seed is not None:
         random.seed(bench_config.initial_seed)
 
@@ -110,6 +257,25 @@ def main(bench_config_file: Path, submit: str) -> None:
                * (bench_config.cpus_per_node / bench_config.mem_lines))
     cache_lines = int(cpus / bench_config.mem_lines)
 
+    rs_time = bench_config.timeout + bench_config.runsolver_term_delay
+    slurm_time = rs_time + bench_config.slurm_time_buffer
+
+    pilot_slots = 0
+    if bench_config.pilot_mode:
+        if bench_config.pilot_nodes < 1:
+            print(f'Pilot mode requires at least one node, but pilot_nodes is {bench_config.pilot_nodes}. Exiting...')
+            exit(2)
+        if bench_config.pilot_time_limit < slurm_time + bench_config.slurm_time_buffer:
+            print(f'pilot_time_limit ({bench_config.pilot_time_limit}s) is too short for a single run '
+                  f'({slurm_time + bench_config.slurm_time_buffer}s). Exiting...')
+            exit(2)
+        if cpus > bench_config.cpus_per_node:
+            print(f'Pilot mode requires runs to fit on a single node, but {cpus} cpus are needed per run '
+                  f'and a node has {bench_config.cpus_per_node}. Exiting...')
+            exit(2)
+        # the cpus of the slots are taken from the node topology by the dispatcher
+        pilot_slots = bench_config.cpus_per_node // cpus
+
     instance_conf = bench_config.instances
     instance_dict = {}
     if isinstance(instance_conf, str):
@@ -123,8 +289,20 @@ def main(bench_config_file: Path, submit: str) -> None:
     if bench_config.exclude_nodes and isinstance(bench_config.exclude_nodes, list):
         bench_config.exclude_nodes = ",".join(bench_config.exclude_nodes)
 
-    rs_time = bench_config.timeout + bench_config.runsolver_term_delay
-    slurm_time = rs_time + bench_config.slurm_time_buffer
+    merge_benches = bench_config.merge_benches and not (isinstance(bench_config.configs, str) and
+                                                         isinstance(instance_conf, str))
+    merged_path = Path(bench_config.name)
+    merged_scripts = []
+    sub_benches = []
+    if merge_benches and os.path.exists(merged_path / 'start_list.txt'):
+        # the array indices of earlier submissions refer to the lines of this file
+        if not bench_config.overwrite:
+            print(f"Merged start list {os.path.realpath(merged_path / 'start_list.txt')} exists and would be replaced. "
+                  f"Make sure no job of the previous submission is pending or running and delete it to regenerate. "
+                  f"Exiting...")
+            exit(2)
+        print(f"Warning: Replacing {os.path.realpath(merged_path / 'start_list.txt')}. Jobs of the previous submission "
+              f"which are still pending or running will execute the wrong runs.")
 
     for instanceset_name, instancelist_filename in instance_dict.items():
         if (instanceset_name.startswith("%") or instanceset_name.startswith("#") or
@@ -189,6 +367,9 @@ def main(bench_config_file: Path, submit: str) -> None:
 
             if os.path.exists(base_path) and not bench_config.overwrite:
                 print(f"Directory {os.path.realpath(base_path)} exists. Skipping...")
+                if merge_benches:
+                    # keep existing runs in the campaign-wide postprocessing
+                    sub_benches += [os.path.relpath(base_path, start=merged_path)]
                 continue
             else:
                 os.makedirs(base_path, exist_ok=True)
@@ -336,7 +517,34 @@ def main(bench_config_file: Path, submit: str) -> None:
                                 cmd = re.sub(r"\$folder{([^}]*)}", repl, cmd, 2)
 
                             cmd = re.sub(r"\$timeout", str(bench_config.timeout * bench_config.timeout_factor), cmd)
-                            cmd = re.sub(r"\$seed", str(random.randint(0, 2 ** 32)), cmd)
+                            seed = random.randint(0, 2 ** 32)
+                            # the seed only determines the run if it is passed to the solver
+                            key_seed = seed if re.search(r"\$seed", cmd) else None
+                            cmd = re.sub(r"\$seed", str(seed), cmd)
+
+                            run_cache_key = None
+                            if run_cache is not None:
+                                solver = cmd.split(' ')[0]
+                                if solver.startswith(str(shm_dir)):
+                                    # solver staged with $file{} or $folder{}, hash its source instead
+                                    staged = solver
+                                    solver = None
+                                    for p, sp in shm_files:
+                                        if staged == str(sp):
+                                            solver = p
+                                        elif str(p).startswith('-r ') and staged.startswith(f'{sp}/'):
+                                            solver = Path(str(p)[3:-2], os.path.relpath(staged, start=sp))
+                                elif not os.path.isabs(os.path.expanduser(solver)):
+                                    if working_dir is not None:
+                                        solver = Path('~', working_dir, solver)
+                                    elif os.sep not in solver:
+                                        solver = shutil.which(solver)
+                                    else:
+                                        # relative to the run directory on the compute node
+                                        solver = None
+                                inputs = [str(p)[3:-2] if str(p).startswith('-r ') else p for p, _ in shm_files]
+                                run_cache_key = run_cache.run_key(solver, cmd.replace(str(shm_dir), '$shm_dir'), inputs,
+                                                                  bench_config.timeout, bench_config.mem_limit, key_seed)
 
                             rs_file = Path(bench_config.runsolver_path).name
                             runsolver_str = Path(shm_dir, 'input', rs_file)
@@ -358,101 +566,42 @@ def main(bench_config_file: Path, submit: str) -> None:
                                                             input_line=input_line, cmd_cwd=bench_config.cmd_cwd,
                                                             cmd_dir=os.path.dirname(cmd.split(' ')[0]),
                                                             starexec=bench_config.starexec_compatible,
-                                                            clearcache_path=bench_config.clearcache_path)
+                                                            clearcache_path=bench_config.clearcache_path,
+                                                            run_cache_dir=run_cache_dir,
+                                                            run_cache_key=run_cache_key)
+                            reused = run_cache is not None and run_cache.restore(run_cache_key, job_path.parent,
+                                                                                  link=bench_config.run_cache_link)
                             with open(f"{job_path}", 'w') as fh:
                                 fh.write(outputText)
 
                             st = os.stat(job_path)
                             os.chmod(job_path, st.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
-                            start_scripts += [job_path]
+                            if reused:
+                                reused_runs += 1
+                            else:
+                                start_scripts += [job_path]
 
                 with open(base_path / 'metadata.json', 'w') as file:
                     file.write(json.dumps(metadata, indent=4))
 
-                with open(base_path / 'start_list.txt', 'w') as file:
-                    for p in start_scripts:
-                        file.write(str(os.path.relpath(p, start=base_path)) + '\n')
-
-                bench_path = os.path.relpath(base_path, start=starthome)
-                slurm_template = templateEnv.get_template('batch_job.slurm.jinja2')
-                slurm_timeout = datetime.timedelta(seconds=slurm_time)
-                mem_per_cpu = int(math.ceil(bench_config.mem_limit / cpus))
-                min_freq = bench_config.cpu_freq * 1000
-                max_freq = bench_config.cpu_freq * 1000
-                output_path = 'slurm_logs'
-                os.makedirs(base_path / output_path, exist_ok=True)
-                outputText = slurm_template.render(benchmark_name=instanceset_name, slurm_timeout=slurm_timeout,
-                                                partition=bench_config.partition, cpus_per_task=cpus,
-                                                mem_per_cpu=mem_per_cpu, email=bench_config.email,
-                                                account=bench_config.billing,
-                                                cache_lines=cache_lines,
-                                                min_freq=min_freq, max_freq=max_freq,
-                                                write_scheduler_logs=bench_config.write_scheduler_logs,
-                                                output_path=output_path,
-                                                max_parallel_jobs=bench_config.max_parallel_jobs,
-                                                lstart_scripts=len(start_scripts), exclusive=bench_config.exclusive,
-                                                bench_path=bench_path,
-                                                exclude_nodes=bench_config.exclude_nodes)
-                with open(base_path / 'batch_job.slurm', 'w') as fh:
-                    fh.write(outputText)
-
-                postprocess_partition = bench_config.partition
-                if bench_config.postprocess_partition != None:
-                    postprocess_partition = bench_config.postprocess_partition
-
-                compress_results_slurm = templateEnv.get_template('compress_results.slurm.jinja2')
-                outputText = compress_results_slurm.render(benchmark_name=instanceset_name, partition=postprocess_partition,
-                                                        bench_path=bench_path,
-                                                        write_scheduler_logs=bench_config.write_scheduler_logs,
-                                                        output_path=output_path,
-                                                        exclude_nodes=bench_config.exclude_nodes)
-                with open(base_path / 'compress_results.slurm', 'w') as fh:
-                    fh.write(outputText)
-
-                module_dir = os.path.dirname(__file__) 
-                postprocess_script_path = os.path.join(module_dir, 'postprocess.py')
-
-                with open(postprocess_script_path, 'r') as f:
-                    postprocess_content = f.read()
-                postprocess_path = Path(base_path, 'postprocess_results.py')
-                postprocess = templateEnv.get_template('postprocess_results.py.jinja2')
-                outputText = postprocess.render(postprocess_script=postprocess_content, regex=bench_config.postprocess_stdout_regex)
-                with open(postprocess_path, 'w') as fh:
-                    fh.write(outputText)
-                st = os.stat(postprocess_path)
-                os.chmod(postprocess_path, st.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
-
-                postprocess_results_slurm = templateEnv.get_template('postprocess_results.slurm.jinja2')
-                outputText = postprocess_results_slurm.render(benchmark_name=instanceset_name, partition=postprocess_partition,
-                                                        bench_path=bench_path,
-                                                        write_scheduler_logs=bench_config.write_scheduler_logs,
-                                                        output_path=output_path,
-                                                        exclude_nodes=bench_config.exclude_nodes,
-                                                        postprocess_script=postprocess_path)
-                with open(base_path / 'postprocess_results.slurm', 'w') as fh:
-                    fh.write(outputText)
-
-
-                submit_sh_path = Path(base_path, 'submit_all.sh')
-                submit_all = templateEnv.get_template('submit_all.sh.jinja2')
-                wd = os.path.relpath(base_path, start=starthome)
-                outputText = submit_all.render(wd=wd)
-                with open(submit_sh_path, 'w') as fh:
-                    fh.write(outputText)
-
-                st = os.stat(submit_sh_path)
-                os.chmod(submit_sh_path, st.st_mode | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH)
-
-                print(f"Wrote files to {os.path.abspath(base_path)}")
-                if submit:
-                    print(f"Submitting jobs directly to slurm...")
-                    os.chdir(os.path.abspath(base_path))
-                    prev_id = None
-                    if submit == "bench" or submit == "all":
-                        prev_id = submit_to_slurm('batch_job.slurm')
-                    if submit == "postprocess" or submit == "all":
-                        prev_id = submit_to_slurm('postprocess_results.slurm', prev_job_id=prev_id)
-                    if submit == "compress" or submit == "all":
-                        prev_id = submit_to_slurm('compress_results.slurm', prev_job_id=prev_id)
-                    
-
+                if merge_benches:
+                    merged_scripts += start_scripts
+                    sub_benches += [os.path.relpath(base_path, start=merged_path)]
+                else:
+                    with open(base_path / 'start_list.txt', 'w') as file:
+                        for p in start_scripts:
+                            file.write(str(os.path.relpath(p, start=base_path)) + '\n')
+
+                    write_jobs(bench_config, templateEnv, starthome, base_path, instanceset_name, start_scripts,
+                               cpus, cache_lines, slurm_time, pilot_slots, submit)
+
+    if merge_benches and len(sub_benches) > 0:
+        with open(merged_path / 'start_list.txt', 'w') as file:
+            for p in merged_scripts:
+                file.write(str(os.path.relpath(p, start=merged_path)) + '\n')
+        write_jobs(bench_config, templateEnv, starthome, merged_path, os.path.basename(os.path.normpath(merged_path)),
+                   merged_scripts, cpus, cache_lines, slurm_time, pilot_slots, submit, sub_benches=sub_benches)
+
+    if run_cache is not None:
+        print(f"Reused {reused_runs} runs from run cache {run_cache.cache_dir}")
+        run_cache.evict()
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+
+FINISHED_LOG = '00_finished.log'
+HASH_CHUNK_SIZE = 1 << 20
+
+
+# Entries are directories named after the run key holding the files of a finished run. They are
+# stored by start.sh and looked up during job generation. Least recently used entries are evicted
+# once the cache exceeds max_size megabytes.
+class RunCache:
+
+    def __init__(self, cache_dir: Union[Path, str], max_size: Optional[int] = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._file_hashes: Dict[Tuple[str, int, int], str] = {}
+        self._missing: Set[str] = set()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def hash_path(self, path: Union[Path, str]) -> Optional[str]:
+        path = os.path.realpath(os.path.expanduser(path))
+        if os.path.isdir(path):
+            h = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    file_path = os.path.join(root, f)
+                    file_hash = self.hash_path(file_path)
+                    if file_hash is None:
+                        return None
+                    h.update(os.path.relpath(file_path, start=path).encode('utf-8'))
+                    h.update(file_hash.encode('utf-8'))
+            return h.hexdigest()
+        if not os.path.isfile(path):
+            return None
+
+        st = os.stat(path)
+        stamp = (path, st.st_size, st.st_mtime_ns)
+        if stamp not in self._file_hashes:
+            h = hashlib.sha256()
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(HASH_CHUNK_SIZE), b''):
+                    h.update(chunk)
+            self._file_hashes[stamp] = h.hexdigest()
+        return self._file_hashes[stamp]
+
+    def run_key(self, solver: Optional[Union[Path, str]], cmd: str, inputs: List[Union[Path, str]],
+                timeout: int, mem_limit: int, seed: Optional[int]) -> Optional[str]:
+        # runs whose solver or inputs cannot be hashed at generation time are not cached
+        if solver is None:
+            self._warn_missing(cmd.split(' ')[0])
+            return None
+        hashes = []
+        for p in [solver] + inputs:
+            h = self.hash_path(p)
+            if h is None:
+                self._warn_missing(p)
+                return None
+            hashes += [h]
+
+        key = {
+            'solver': hashes[0],
+            'cmd': cmd,
+            'inputs': hashes[1:],
+            'timeout': timeout,
+            'mem_limit': mem_limit,
+            'seed': seed
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _warn_missing(self, path: Union[Path, str]) -> None:
+        if str(path) not in self._missing:
+            self._missing.add(str(path))
+            print(f'Warning: Cannot resolve {path} to a local file or folder. Runs using it are not cached.')
+
+    def entry_path(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def restore(self, key: Optional[str], log_folder: Union[Path, str], link: bool = False) -> bool:
+        if key is None:
+            return False
+        entry = self.entry_path(key)
+        if not (entry / FINISHED_LOG).exists():
+            return False
+
+        os.makedirs(log_folder, exist_ok=True)
+        for f in os.scandir(entry):
+            target = Path(log_folder, f.name)
+            if target.exists() or target.is_symlink():
+                os.remove(target)
+            if link:
+                try:
+                    os.link(f.path, target)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(f.path, target)
+        # mark entry as recently used
+        os.utime(entry)
+        return True
+
+    def evict(self) -> None:
+        # clean up entries of runs that were killed while storing their results
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.') and entry.is_dir() and time.time() - entry.stat().st_mtime > 24 * 3600:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        if self.max_size is None:
+            return
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry) if f.is_file())
+            entries += [(entry.stat().st_mtime, size, entry.path)]
+            total += size
+
+        entries.sort()
+        limit = self.max_size * 1024 * 1024
+        evicted = 0
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted += 1
+
+        if evicted > 0:
+            print(f'Evicted {evicted} runs from run cache {os.path.realpath(self.cache_dir)}')
@@ -0,0 +1,68 @@
+import json
+
+from click.testing import CliRunner
+
+from copperbench import bench
+
+
+def generate(tmp_path, monkeypatch, configs, **options):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    config = {
+        'name': 'campaign',
+        'configs': configs,
+        'instances': {'set1': 'instances.txt', 'set2': 'instances.txt'},
+        'timeout': 10,
+        'mem_limit': 100,
+        'request_cpus': 1,
+        'executable': '/bin/echo',
+        'merge_benches': True
+    } | options
+    with open(tmp_path / 'bench.json', 'w') as fh:
+        fh.write(json.dumps(config))
+    return CliRunner().invoke(bench.main, [str(tmp_path / 'bench.json')])
+
+
+def setup_files(tmp_path):
+    (tmp_path / 'a.cnf').write_text('a')
+    (tmp_path / 'instances.txt').write_text('a.cnf\n')
+    (tmp_path / 'configs.txt').write_text('--opt 1\n--opt 2\n')
+
+
+def test_merged_start_list(tmp_path, monkeypatch):
+    setup_files(tmp_path)
+    result = generate(tmp_path, monkeypatch, {'c1': 'configs.txt', 'c2': 'configs.txt'})
+    assert result.exit_code == 0, result.output
+    start_list = (tmp_path / 'campaign' / 'start_list.txt').read_text().splitlines()
+    assert len(start_list) == 8
+    assert all((tmp_path / 'campaign' / p).exists() for p in start_list)
+    assert not (tmp_path / 'campaign' / 'c1' / 'set1' / 'start_list.txt').exists()
+
+
+def test_existing_merged_start_list_is_not_replaced(tmp_path, monkeypatch):
+    setup_files(tmp_path)
+    generate(tmp_path, monkeypatch, {'c1': 'configs.txt'})
+    start_list = (tmp_path / 'campaign' / 'start_list.txt').read_text()
+
+    result = generate(tmp_path, monkeypatch, {'c1': 'configs.txt', 'c2': 'configs.txt'})
+    assert result.exit_code == 2
+    assert (tmp_path / 'campaign' / 'start_list.txt').read_text() == start_list
+    assert not (tmp_path / 'campaign' / 'c2').exists()
+
+    (tmp_path / 'campaign' / 'start_list.txt').unlink()
+    result = generate(tmp_path, monkeypatch, {'c1': 'configs.txt', 'c2': 'configs.txt'})
+    assert result.exit_code == 0, result.output
+    assert len((tmp_path / 'campaign' / 'start_list.txt').read_text().splitlines()) == 4
+    assert '"c1/set1", "c2/set1", "c1/set2", "c2/set2"' in (tmp_path / 'campaign' / 'postprocess_results.py').read_text()
+
+
+def test_merged_array_exceeding_max_array_size(tmp_path, monkeypatch):
+    setup_files(tmp_path)
+    result = generate(tmp_path, monkeypatch, {'c1': 'configs.txt', 'c2': 'configs.txt'}, max_array_size=8)
+    assert result.exit_code == 2
+    assert 'exceed the maximum array size' in result.output
+    assert not (tmp_path / 'campaign' / 'batch_job.slurm').exists()
+
+    result = generate(tmp_path, monkeypatch, {'c1': 'configs.txt', 'c2': 'configs.txt'}, max_array_size=8,
+                      pilot_mode=True, overwrite=True)
+    assert result.exit_code == 0, result.output
@@ -0,0 +1,90 @@
+import json
+import os
+import re
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from copperbench import bench
+from copperbench.runcache import RunCache
+
+
+def generate(tmp_path, monkeypatch, name, **options):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    config = {
+        'name': name,
+        'configs': 'configs.txt',
+        'instances': 'instances.txt',
+        'timeout': 10,
+        'mem_limit': 100,
+        'request_cpus': 1,
+        'executable': '$file{solver}',
+        'run_cache': 'cache'
+    } | options
+    with open(tmp_path / f'{name}.json', 'w') as fh:
+        fh.write(json.dumps(config))
+    result = CliRunner().invoke(bench.main, [str(tmp_path / f'{name}.json')])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def fill_cache(bench_dir):
+    # simulate start.sh storing finished runs in the cache
+    for start in Path(bench_dir).glob('config*/instance*/run*/start.sh'):
+        key = re.search(r'cache/([0-9a-f]{64}) \]', start.read_text()).group(1)
+        entry = Path(bench_dir).parent / 'cache' / key
+        entry.mkdir(parents=True)
+        (entry / 'stdout.log').write_text('result')
+        (entry / '00_finished.log').touch()
+
+
+def setup_files(tmp_path):
+    (tmp_path / 'solver').write_text('#!/bin/sh\n')
+    (tmp_path / 'a.cnf').write_text('a')
+    (tmp_path / 'b.cnf').write_text('b')
+    (tmp_path / 'instances.txt').write_text('a.cnf\nb.cnf\n')
+    (tmp_path / 'configs.txt').write_text('--opt 1\n--opt 2\n')
+
+
+def test_second_generation_reuses_runs(tmp_path, monkeypatch):
+    setup_files(tmp_path)
+    generate(tmp_path, monkeypatch, 'bench1')
+    assert len((tmp_path / 'bench1' / 'start_list.txt').read_text().splitlines()) == 4
+    fill_cache(tmp_path / 'bench1')
+
+    output = generate(tmp_path, monkeypatch, 'bench2')
+    assert 'Reused 4 runs' in output
+    assert (tmp_path / 'bench2' / 'start_list.txt').read_text() == ''
+    assert (tmp_path / 'bench2' / 'config1' / 'instance1' / 'run1' / 'stdout.log').read_text() == 'result'
+
+
+def test_changed_instance_is_not_reused(tmp_path, monkeypatch):
+    setup_files(tmp_path)
+    generate(tmp_path, monkeypatch, 'bench1')
+    fill_cache(tmp_path / 'bench1')
+
+    (tmp_path / 'b.cnf').write_text('changed')
+    output = generate(tmp_path, monkeypatch, 'bench2')
+    assert 'Reused 2 runs' in output
+    assert len((tmp_path / 'bench2' / 'start_list.txt').read_text().splitlines()) == 2
+
+
+def test_unresolvable_solver_is_not_cached(tmp_path, monkeypatch):
+    setup_files(tmp_path)
+    output = generate(tmp_path, monkeypatch, 'bench1', executable='./missing')
+    assert 'Runs using it are not cached' in output
+    start = (tmp_path / 'bench1' / 'config1' / 'instance1' / 'run1' / 'start.sh').read_text()
+    assert 'run cache' not in start
+
+
+def test_evict_removes_stale_temp_dirs_without_size_limit(tmp_path):
+    cache = RunCache(tmp_path / 'cache')
+    stale = tmp_path / 'cache' / '.key.abc123'
+    stale.mkdir()
+    os.utime(stale, (0, 0))
+    fresh = tmp_path / 'cache' / '.key.def456'
+    fresh.mkdir()
+    cache.evict()
+    assert not stale.exists()
+    assert fresh.exists()